@@ -1,5 +1,16 @@
+import asyncio
+import hashlib
+import heapq
+import logging
+import math
 import os
+import queue
+import threading
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from functools import partial
 from typing import Optional
 
 from fastapi import FastAPI, File, UploadFile, Form, Request
@@ -7,8 +18,23 @@ from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
+import aiofiles
 from ultralytics import YOLO
+from ultralytics.utils.plotting import Annotator, colors
 import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+try:
+    import av
+except ImportError:  # PyAV is optional; videos are then decoded/encoded with OpenCV
+    av = None
+
+try:
+    import ffmpegcv
+except ImportError:  # only needed for NVDEC decoding (VIDEO_NVDEC=1)
+    ffmpegcv = None
 
 # ----- Paths & Config -----
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -17,8 +43,65 @@ OUTPUT_DIR = os.getenv("OUTPUT_DIR", os.path.join(BASE_DIR, "outputs"))
 STATIC_DIR = os.path.join(BASE_DIR, "static")
 TEMPLATES_DIR = os.path.join(BASE_DIR, "templates")
 
+# TensorRT engine export settings (CUDA only). MODEL_PATH may point at a
+# .pt checkpoint or at an already exported .engine file.
+ENGINE_IMGSZ = int(os.getenv("ENGINE_IMGSZ", "640"))
+ENGINE_BATCH = int(os.getenv("ENGINE_BATCH", "8"))
+# fp32 runs the .pt as-is; fp16 / int8 export a TensorRT engine. int8 needs a
+# dataset yaml in CALIB_DATA for calibration and falls back to fp16 otherwise.
+PRECISION = os.getenv("PRECISION", "fp16").lower()
+PRECISIONS = ("fp32", "fp16", "int8")
+CALIB_DATA = os.getenv("CALIB_DATA")
+
+# When the PyTorch weights are served on CUDA, forward passes of up to
+# max(COMPILE_BATCHES) images whose long side is COMPILE_IMGSZ are padded to
+# (B, 3, COMPILE_IMGSZ, COMPILE_IMGSZ) with B in COMPILE_BATCHES and run through
+# torch.compile(mode="reduce-overhead") (CUDA Graphs); other inputs stay eager.
+COMPILE_IMGSZ = int(os.getenv("COMPILE_IMGSZ", "640"))
+COMPILE_BATCHES = (1, 4, 8)
+
+# Image size of the dummy inferences run at startup; square, 16:9 and 9:16 inputs
+# are warmed up since letterboxing gives each aspect ratio its own input shape
+WARMUP_IMGSZ = int(os.getenv("WARMUP_IMGSZ", "640"))
+
+# Concurrent image requests are coalesced into one forward pass of up to
+# MAX_BATCH images, waiting at most BATCH_TIMEOUT seconds to fill a batch.
+MAX_BATCH = int(os.getenv("MAX_BATCH", "8"))
+BATCH_TIMEOUT = float(os.getenv("BATCH_TIMEOUT", "0.01"))
+
+# Annotated images of the last IMAGE_CACHE_SIZE distinct (upload, conf, imgsz)
+# requests are reused instead of re-running inference (0 disables)
+IMAGE_CACHE_SIZE = max(0, int(os.getenv("IMAGE_CACHE_SIZE", "256")))
+
+# Video frames are decoded, inferred in batches of VIDEO_BATCH and encoded on
+# separate threads; VIDEO_PREFETCH bounds each hand-off queue.
+VIDEO_BATCH = int(os.getenv("VIDEO_BATCH", "8"))
+VIDEO_PREFETCH = int(os.getenv("VIDEO_PREFETCH", "32"))
+# At most VIDEO_WORKERS videos are processed at once on their own thread pool,
+# so long jobs never take the threads image requests rely on; the rest wait.
+VIDEO_WORKERS = max(1, int(os.getenv("VIDEO_WORKERS", "2")))
+
+# Lowest accepted sample_fps; blank means every frame
+MIN_SAMPLE_FPS = 0.1
+
+# Decode on the GPU (NVDEC) through ffmpegcv instead of PyAV / OpenCV
+VIDEO_NVDEC = os.getenv("VIDEO_NVDEC", "0") == "1"
+
+# H.264 encoders tried in order through PyAV (NVENC first, then x264 on the CPU)
+VIDEO_ENCODERS = os.getenv("VIDEO_ENCODERS", "h264_nvenc,libx264").split(",")
+
+# Video uploads are streamed to disk in UPLOAD_CHUNK pieces; image uploads
+# are read into memory and rejected above MAX_IMAGE_BYTES.
+UPLOAD_CHUNK = 1024 * 1024
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+
+IMAGE_EXTS = [".jpg", ".jpeg", ".png", ".bmp", ".webp"]
+VIDEO_EXTS = [".mp4", ".avi", ".mov", ".mkv", ".webm"]
+
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+logger = logging.getLogger("uvicorn.error")
+
 app = FastAPI(title="Traffic Sign Detection (YOLO)")
 
 # Static and templates
@@ -26,11 +109,539 @@ app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 app.mount("/outputs", StaticFiles(directory=OUTPUT_DIR), name="outputs")
 templates = Jinja2Templates(directory=TEMPLATES_DIR)
 
+def build_engine(pt_path: str, precision: str) -> Optional[str]:
+    # Cache the engine next to the checkpoint, keyed on everything the export depends on;
+    # re-export when the checkpoint is newer than the cached engine
+    stem = os.path.splitext(pt_path)[0]
+    engine_path = f"{stem}.{precision}.{ENGINE_IMGSZ}x{ENGINE_BATCH}.engine"
+    if os.path.exists(engine_path) and os.path.getmtime(engine_path) >= os.path.getmtime(pt_path):
+        return engine_path
+    try:
+        exported = YOLO(pt_path).export(
+            format="engine",
+            half=precision == "fp16",
+            int8=precision == "int8",
+            data=CALIB_DATA if precision == "int8" else None,
+            dynamic=True,
+            batch=ENGINE_BATCH,
+            imgsz=ENGINE_IMGSZ,
+        )
+    except Exception as exc:
+        logger.warning("TensorRT %s export failed: %s", precision, exc)
+        return None
+    os.replace(exported, engine_path)
+    return engine_path
+
+
+def trim_batch(out, n: int):
+    if isinstance(out, torch.Tensor):
+        return out[:n]
+    return type(out)(trim_batch(o, n) for o in out)
+
+
+def load_engine(engine_path: str):
+    yolo = YOLO(engine_path, task="detect")
+    # The engine is only deserialized on the first predict, so run one to catch
+    # corrupt engines or ones built by another TensorRT version
+    dummy = np.zeros((ENGINE_IMGSZ, ENGINE_IMGSZ, 3), dtype=np.uint8)
+    yolo.predict(source=dummy, imgsz=ENGINE_IMGSZ, verbose=False)
+    return yolo
+
+
+def compile_model(yolo):
+    net = yolo.model
+    eager = net.forward
+    compiled = torch.compile(eager, mode="reduce-overhead", dynamic=False)
+
+    def forward(x, *args, **kwargs):
+        # Letterboxing gives .pt models rectangular, stride-aligned inputs (e.g. 384x640),
+        # so pad them up to the one captured shape instead of only matching exact squares.
+        # Only inputs whose long side is COMPILE_IMGSZ qualify: a smaller imgsz padded to
+        # the captured square would cost more than its own eager pass.
+        b, _, h, w = x.shape
+        size = next((n for n in COMPILE_BATCHES if n >= b), None)
+        if size is None or max(h, w) != COMPILE_IMGSZ:
+            return eager(x, *args, **kwargs)
+        # Padding goes bottom/right in letterbox grey, so box coordinates (measured
+        # from the top-left) stay valid; extra batch slots are blank and dropped
+        x = F.pad(x, (0, COMPILE_IMGSZ - w, 0, COMPILE_IMGSZ - h), value=114 / 255)
+        if size > b:
+            x = torch.cat([x, x.new_zeros((size - b, *x.shape[1:]))])
+        return trim_batch(compiled(x, *args, **kwargs), b)
+
+    net.forward = forward
+    try:
+        # Capture the graphs now instead of on the first requests of each batch size
+        for b in COMPILE_BATCHES:
+            dummy = np.zeros((COMPILE_IMGSZ, COMPILE_IMGSZ, 3), dtype=np.uint8)
+            yolo.predict(source=[dummy] * b, imgsz=COMPILE_IMGSZ, verbose=False)
+    except Exception as exc:
+        logger.warning("torch.compile warmup failed, using eager forward: %s", exc)
+        net.forward = eager
+        return False
+    return True
+
+
+def warmup_model(yolo):
+    # Pay for CUDA context init, predictor setup and kernel selection before the first request
+    short = WARMUP_IMGSZ * 9 // 16
+    try:
+        for h, w in ((WARMUP_IMGSZ, WARMUP_IMGSZ), (short, WARMUP_IMGSZ), (WARMUP_IMGSZ, short)):
+            dummy = np.zeros((h, w, 3), dtype=np.uint8)
+            yolo.predict(source=dummy, imgsz=WARMUP_IMGSZ, verbose=False)
+    except Exception as exc:
+        logger.warning("Model warmup failed: %s", exc)
+
+
+# ----- Inference thread -----
+# Every model load, warmup and predict runs on this one thread: the YOLO predictor
+# is not thread-safe, and torch.compile's CUDA graphs are recorded per thread, so
+# predicts from other threads would re-record them instead of replaying the warmed ones.
+infer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="infer")
+# Video jobs get their own pool (see VIDEO_WORKERS) instead of the default executor
+video_executor = ThreadPoolExecutor(max_workers=VIDEO_WORKERS, thread_name_prefix="video")
+
+
+def predict_sync(**kwargs):
+    # For callers already off the event loop (e.g. the video pipeline)
+    return infer_executor.submit(partial(model.predict, **kwargs)).result()
+
+
+def init_model():
+    global model, MAX_BATCH, VIDEO_BATCH
+    if PRECISION not in PRECISIONS:
+        raise ValueError(f"PRECISION must be one of {', '.join(PRECISIONS)}, got {PRECISION!r}")
+    engine_path = None
+    if MODEL_PATH.endswith(".engine"):
+        engine_path = MODEL_PATH
+    elif torch.cuda.is_available() and PRECISION != "fp32":
+        if PRECISION == "int8":
+            if CALIB_DATA:
+                engine_path = build_engine(MODEL_PATH, "int8")
+            else:
+                logger.warning("PRECISION=int8 needs CALIB_DATA for calibration, using fp16")
+        engine_path = engine_path or build_engine(MODEL_PATH, "fp16")
+
+    model = None
+    if engine_path:
+        try:
+            model = load_engine(engine_path)
+        except Exception as exc:
+            if engine_path == MODEL_PATH:
+                raise
+            logger.warning("Could not load TensorRT engine %s, using PyTorch weights: %s", engine_path, exc)
+        else:
+            # Larger batches would fail the engine's max input shape. Read it from the
+            # loaded engine: a user-supplied one may not match ENGINE_BATCH (or be static batch 1)
+            engine_batch = model.predictor.model.batch_size
+            MAX_BATCH = min(MAX_BATCH, engine_batch)
+            VIDEO_BATCH = min(VIDEO_BATCH, engine_batch)
+
+    if model is None:
+        model = YOLO(MODEL_PATH)
+        model.fuse()
+        if torch.cuda.is_available():
+            # cuDNN autotuning pays off only when the compiled path pins the input shape;
+            # the eager path sees a new shape per aspect ratio and would re-tune for each
+            torch.backends.cudnn.benchmark = True
+            if not compile_model(model):
+                torch.backends.cudnn.benchmark = False
+    warmup_model(model)
+
+
 # Load model once at startup
 @app.on_event("startup")
 def load_model():
-    global model
-    model = YOLO(MODEL_PATH)
+    infer_executor.submit(init_model).result()
+
+
+# ----- Batched image inference -----
+@app.on_event("startup")
+async def start_batch_worker():
+    global infer_queue, batch_task
+    infer_queue = asyncio.Queue()
+    batch_task = asyncio.create_task(batch_worker())
+
+
+@app.on_event("shutdown")
+async def stop_batch_worker():
+    batch_task.cancel()
+
+
+async def batch_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await infer_queue.get()]
+        deadline = loop.time() + BATCH_TIMEOUT
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(infer_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Requests with different conf/imgsz can't share a forward pass
+        groups = {}
+        for img, conf, imgsz, fut in batch:
+            groups.setdefault((conf, imgsz), []).append((img, fut))
+
+        for (conf, imgsz), items in groups.items():
+            try:
+                results = await loop.run_in_executor(
+                    infer_executor,
+                    partial(
+                        model.predict,
+                        source=[img for img, _ in items],
+                        conf=conf,
+                        imgsz=imgsz,
+                        verbose=False,
+                    ),
+                )
+            except Exception as exc:
+                for _, fut in items:
+                    if not fut.done():
+                        fut.set_exception(exc)
+                continue
+            for (_, fut), result in zip(items, results):
+                if not fut.done():
+                    fut.set_result(result)
+
+
+def draw_detections(frame: np.ndarray, result) -> np.ndarray:
+    # Draws into `frame` itself; result.plot() would deep-copy it every call.
+    # PyAV hands back row-padded (non-contiguous) views for some widths, which
+    # OpenCV drawing and the encoders can't use in place.
+    if not frame.flags.c_contiguous:
+        frame = np.ascontiguousarray(frame)
+
+    # One device->host copy per frame rather than several per box
+    data = result.boxes.data.cpu().numpy()
+    annotator = Annotator(frame, example=result.names)
+    for det in data[::-1]:
+        c = int(det[-1])
+        annotator.box_label(det[:4], f"{result.names[c]} {det[-2]:.2f}", color=colors(c, True))
+    return annotator.result()
+
+
+async def queue_submit(img: np.ndarray, conf: float, imgsz: int):
+    fut = asyncio.get_running_loop().create_future()
+    await infer_queue.put((img, conf, imgsz, fut))
+    return await fut
+
+
+# ----- Threaded video pipeline -----
+def put_until_stopped(q: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def get_until_stopped(q: queue.Queue, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return None
+
+
+class AVVideoWriter:
+    """Minimal cv2.VideoWriter-compatible wrapper around a PyAV H.264 stream."""
+
+    def __init__(self, path: str, fps: float, w: int, h: int, codec: str):
+        # yuv420p needs even dimensions; odd frames get one replicated row/column
+        self.pad_w, self.pad_h = w % 2, h % 2
+        self.container = av.open(path, mode="w")
+        try:
+            self.stream = self.container.add_stream(codec, rate=Fraction(fps).limit_denominator(1001))
+            self.stream.width, self.stream.height = w + self.pad_w, h + self.pad_h
+            self.stream.pix_fmt = "yuv420p"
+            # Open eagerly so a missing GPU / encoder fails here rather than mid-video
+            self.stream.codec_context.open()
+        except Exception:
+            self.container.close()
+            raise
+
+    def write(self, frame: np.ndarray):
+        if self.pad_w or self.pad_h:
+            frame = cv2.copyMakeBorder(frame, 0, self.pad_h, 0, self.pad_w, cv2.BORDER_REPLICATE)
+        self.container.mux(self.stream.encode(av.VideoFrame.from_ndarray(frame, format="bgr24")))
+
+    def release(self):
+        self.container.mux(self.stream.encode())
+        self.container.close()
+
+
+def open_video_writer(path: str, fps: float, w: int, h: int):
+    if av is not None:
+        for codec in VIDEO_ENCODERS:
+            try:
+                return AVVideoWriter(path, fps, w, h, codec.strip())
+            except Exception as exc:
+                logger.debug("Video encoder %s unavailable: %s", codec, exc)
+        logger.warning("No H.264 encoder from %s could be opened, writing mp4v", VIDEO_ENCODERS)
+    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+    return cv2.VideoWriter(path, fourcc, fps, (w, h))
+
+
+def parse_sample_fps(value: Optional[str]) -> Optional[float]:
+    # Parsed by hand: FastAPI 0.115 rejects a blank form field for Optional[float]
+    if value is None or not value.strip():
+        return None
+    fps = float(value)
+    if not math.isfinite(fps) or fps < MIN_SAMPLE_FPS:
+        raise ValueError(f"sample_fps must be a number >= {MIN_SAMPLE_FPS}")
+    return fps
+
+
+def sample_step(fps: float, sample_fps: Optional[float]) -> int:
+    return max(1, int(round(fps / sample_fps))) if sample_fps else 1
+
+
+# Clockwise rotation (degrees) from the container metadata -> cv2.rotate code
+ROTATE_CODES = {
+    90: cv2.ROTATE_90_CLOCKWISE,
+    180: cv2.ROTATE_180,
+    270: cv2.ROTATE_90_COUNTERCLOCKWISE,
+}
+
+
+def iter_frames_av(container, stream, skip: int, rotate_code: Optional[int]):
+    # Frames that are skipped are decoded but never converted to BGR
+    try:
+        for pos, frame in enumerate(container.decode(stream)):
+            if pos % skip == 0:
+                arr = frame.to_ndarray(format="bgr24")
+                yield arr if rotate_code is None else cv2.rotate(arr, rotate_code)
+    finally:
+        container.close()
+
+
+def iter_frames_cv2(cap, skip: int):
+    # Frames that are skipped are only grabbed, never retrieved
+    try:
+        pos = 0
+        while cap.grab():
+            if pos % skip == 0:
+                ok, frame = cap.retrieve()
+                if not ok:
+                    break
+                yield frame
+            pos += 1
+    finally:
+        cap.release()
+
+
+def iter_frames_nv(cap, first: np.ndarray, skip: int):
+    try:
+        frame, pos = first, 0
+        while True:
+            if pos % skip == 0:
+                yield frame
+            ok, frame = cap.read()
+            if not ok:
+                break
+            pos += 1
+    finally:
+        cap.release()
+
+
+def open_nvdec_reader(path: str, sample_fps: Optional[float]):
+    # ffmpegcv doesn't reliably apply rotation metadata, so leave rotated videos to PyAV / OpenCV
+    probe = cv2.VideoCapture(path)
+    rotation = int(probe.get(cv2.CAP_PROP_ORIENTATION_META)) % 360
+    probe.release()
+    if rotation:
+        return None
+
+    cap = None
+    try:
+        cap = ffmpegcv.VideoCaptureNV(path, pix_fmt="bgr24")
+        # cuvid errors (e.g. an unsupported codec) only surface once decoding starts
+        ok, first = cap.read()
+        if not ok:
+            raise RuntimeError("no frames decoded")
+    except Exception as exc:
+        logger.warning("NVDEC decoding failed, falling back to CPU decoding: %s", exc)
+        if cap is not None:
+            cap.release()
+        return None
+    fps = cap.fps or 20.0
+    skip = sample_step(fps, sample_fps)
+    return fps / skip, cap.width, cap.height, iter_frames_nv(cap, first, skip)
+
+
+def open_video_reader(path: str, sample_fps: Optional[float]):
+    """Return (output fps, width, height, upright BGR frame iterator) for `path`."""
+    if VIDEO_NVDEC and ffmpegcv is not None:
+        reader = open_nvdec_reader(path, sample_fps)
+        if reader is not None:
+            return reader
+
+    if av is not None:
+        container = av.open(path)
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        fps = float(stream.average_rate or 20.0)
+        skip = sample_step(fps, sample_fps)
+        w, h = stream.codec_context.width, stream.codec_context.height
+        # PyAV doesn't apply the display matrix (phone videos); ffmpeg reports it counter-clockwise
+        rotation = int(round(-stream.side_data.get("DISPLAYMATRIX", 0))) % 360
+        rotate_code = ROTATE_CODES.get(rotation)
+        if rotation in (90, 270):
+            w, h = h, w
+        return fps / skip, w, h, iter_frames_av(container, stream, skip, rotate_code)
+
+    cap = cv2.VideoCapture(path)
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    # Rotate to the display orientation; the reported frame size follows it
+    cap.set(cv2.CAP_PROP_ORIENTATION_AUTO, 1)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 20.0
+    skip = sample_step(fps, sample_fps)
+    w, h = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    return fps / skip, w, h, iter_frames_cv2(cap, skip)
+
+
+def process_video(
+    src_path: str, out_path: str, conf: float, imgsz: int, sample_fps: Optional[float] = None
+):
+    # reader thread: decode -> read_q -> this thread: batched inference -> write_q -> writer thread: encode
+    fps, w, h, frames = open_video_reader(src_path, sample_fps)
+    writer = open_video_writer(out_path, fps, w, h)
+
+    read_q = queue.Queue(maxsize=VIDEO_PREFETCH)
+    write_q = queue.Queue(maxsize=VIDEO_PREFETCH)
+    stop = threading.Event()
+    errors = []
+
+    def read_frames():
+        try:
+            for idx, frame in enumerate(frames):
+                if not put_until_stopped(read_q, (idx, frame), stop):
+                    break
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            frames.close()
+            put_until_stopped(read_q, None, stop)
+
+    def write_frames():
+        # Frames are written strictly in index order, whatever order they arrive in
+        pending = []
+        next_idx = 0
+        try:
+            while True:
+                item = get_until_stopped(write_q, stop)
+                if item is None:
+                    break
+                heapq.heappush(pending, item)
+                while pending and pending[0][0] == next_idx:
+                    writer.write(heapq.heappop(pending)[1])
+                    next_idx += 1
+        except Exception as exc:
+            errors.append(exc)
+            stop.set()
+
+    reader_thread = threading.Thread(target=read_frames, daemon=True)
+    writer_thread = threading.Thread(target=write_frames, daemon=True)
+    reader_thread.start()
+    writer_thread.start()
+
+    try:
+        batch = []
+        while True:
+            item = get_until_stopped(read_q, stop)
+            if item is not None:
+                batch.append(item)
+            if batch and (item is None or len(batch) == VIDEO_BATCH):
+                results = predict_sync(
+                    source=[frame for _, frame in batch], conf=conf, imgsz=imgsz, verbose=False
+                )
+                for (idx, frame), result in zip(batch, results):
+                    put_until_stopped(write_q, (idx, draw_detections(frame, result)), stop)
+                batch = []
+            if item is None:
+                break
+        put_until_stopped(write_q, None, stop)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        reader_thread.join()
+        writer_thread.join()
+        writer.release()
+
+    if errors:
+        raise errors[0]
+
+
+async def save_upload(file: UploadFile, path: str):
+    async with aiofiles.open(path, "wb") as out:
+        while chunk := await file.read(UPLOAD_CHUNK):
+            await out.write(chunk)
+
+
+async def read_image_upload(file: UploadFile) -> Optional[bytes]:
+    raw = await file.read(MAX_IMAGE_BYTES + 1)
+    return None if len(raw) > MAX_IMAGE_BYTES else raw
+
+
+def media_kind(content_type: str, suffix: str) -> Optional[str]:
+    if content_type.startswith("image/") or suffix in IMAGE_EXTS:
+        return "image"
+    if content_type.startswith("video/") or suffix in VIDEO_EXTS:
+        return "video"
+    return None
+
+
+# Only touched from the event loop and each operation is atomic there, so no lock is needed.
+# Lookup and insert are separated by awaits (hashing, inference), so concurrent misses on
+# the same image just both run inference and the later insert wins.
+image_cache: "OrderedDict[tuple, str]" = OrderedDict()
+
+
+def image_digest(raw: bytes) -> bytes:
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
+
+def decode_image(raw: bytes) -> Optional[np.ndarray]:
+    return cv2.imdecode(np.frombuffer(raw, np.uint8), cv2.IMREAD_COLOR)
+
+
+def save_annotated(img: np.ndarray, result, path: str):
+    cv2.imwrite(path, draw_detections(img, result))
+
+
+async def annotate_image(raw: bytes, conf: float, imgsz: int, stem: str) -> Optional[str]:
+    # Hashing, decoding, drawing and JPEG encoding are CPU-bound: keep them off the event loop
+    loop = asyncio.get_running_loop()
+    key = (await loop.run_in_executor(None, image_digest, raw), conf, imgsz)
+    cached = image_cache.get(key)
+    if cached and os.path.exists(os.path.join(OUTPUT_DIR, cached)):
+        image_cache.move_to_end(key)
+        return cached
+
+    # Decode straight from the upload bytes; only the annotated result touches disk
+    img = await loop.run_in_executor(None, decode_image, raw)
+    if img is None:
+        return None
+    result = await queue_submit(img, conf, imgsz)
+    out_name = f"annotated_{stem}.jpg"
+    await loop.run_in_executor(
+        None, save_annotated, img, result, os.path.join(OUTPUT_DIR, out_name)
+    )
+
+    image_cache[key] = out_name
+    image_cache.move_to_end(key)
+    while len(image_cache) > IMAGE_CACHE_SIZE:
+        image_cache.popitem(last=False)
+    return out_name
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -47,61 +658,63 @@ async def detect(
     file: UploadFile = File(...),
     conf: float = Form(0.25),
     imgsz: int = Form(640),
+    sample_fps: Optional[str] = Form(None),
 ):
-    # Save upload to outputs dir
     suffix = os.path.splitext(file.filename)[1].lower()
     temp_name = f"{uuid.uuid4().hex}{suffix}"
-    temp_path = os.path.join(OUTPUT_DIR, temp_name)
-    with open(temp_path, "wb") as f:
-        f.write(await file.read())
-
-    # Determine media type
-    content_type = file.content_type or ""
-    is_image = content_type.startswith("image/") or suffix in [
-        ".jpg",
-        ".jpeg",
-        ".png",
-        ".bmp",
-        ".webp",
-    ]
-    is_video = content_type.startswith("video/") or suffix in [
-        ".mp4",
-        ".avi",
-        ".mov",
-        ".mkv",
-        ".webm",
-    ]
-
-    if is_image:
-        # Inference on image
-        results = model.predict(source=temp_path, conf=conf, imgsz=imgsz, verbose=False)
-        annotated = results[0].plot()
-        out_name = f"annotated_{os.path.splitext(temp_name)[0]}.jpg"
-        out_path = os.path.join(OUTPUT_DIR, out_name)
-        cv2.imwrite(out_path, annotated)
+    kind = media_kind(file.content_type or "", suffix)
+    try:
+        sample_fps = parse_sample_fps(sample_fps)
+    except ValueError:
+        return templates.TemplateResponse(
+            "index.html",
+            {
+                "request": request,
+                "error": f"Video FPS must be a number of at least {MIN_SAMPLE_FPS}.",
+                "result_url": None,
+                "media_type": None,
+            },
+        )
+
+    if kind == "image":
+        raw = await read_image_upload(file)
+        if raw is None:
+            return templates.TemplateResponse(
+                "index.html",
+                {
+                    "request": request,
+                    "error": f"Image is larger than {MAX_IMAGE_BYTES // (1024 * 1024)} MB.",
+                    "result_url": None,
+                    "media_type": None,
+                },
+            )
+
+        # Inference on image (batched with other in-flight requests)
+        out_name = await annotate_image(raw, conf, imgsz, os.path.splitext(temp_name)[0])
+        if out_name is None:
+            return templates.TemplateResponse(
+                "index.html",
+                {
+                    "request": request,
+                    "error": "Could not decode the uploaded image.",
+                    "result_url": None,
+                    "media_type": None,
+                },
+            )
         result_url = f"/outputs/{out_name}"
         media_type = "image"
 
-    elif is_video:
+    elif kind == "video":
+        # Save upload to outputs dir
+        temp_path = os.path.join(OUTPUT_DIR, temp_name)
+        await save_upload(file, temp_path)
+
         # Streaming inference on video
-        cap = cv2.VideoCapture(temp_path)
-        fps = cap.get(cv2.CAP_PROP_FPS) or 20.0
-        w, h = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(
-            cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
-        )
         out_name = f"annotated_{os.path.splitext(temp_name)[0]}.mp4"
         out_path = os.path.join(OUTPUT_DIR, out_name)
-        fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-        writer = cv2.VideoWriter(out_path, fourcc, fps, (w, h))
-
-        for result in model.predict(
-            source=temp_path, conf=conf, imgsz=imgsz, stream=True, verbose=False
-        ):
-            frame = result.plot()
-            writer.write(frame)
-
-        cap.release()
-        writer.release()
+        await asyncio.get_running_loop().run_in_executor(
+            video_executor, process_video, temp_path, out_path, conf, imgsz, sample_fps
+        )
         result_url = f"/outputs/{out_name}"
         media_type = "video"
 
@@ -124,44 +737,38 @@ async def detect(
 
 # JSON API endpoint
 @app.post("/api/detect")
-async def api_detect(file: UploadFile = File(...), conf: float = Form(0.25), imgsz: int = Form(640)):
+async def api_detect(
+    file: UploadFile = File(...),
+    conf: float = Form(0.25),
+    imgsz: int = Form(640),
+    sample_fps: Optional[str] = Form(None),
+):
     suffix = os.path.splitext(file.filename)[1].lower()
     temp_name = f"{uuid.uuid4().hex}{suffix}"
-    temp_path = os.path.join(OUTPUT_DIR, temp_name)
-    with open(temp_path, "wb") as f:
-        f.write(await file.read())
-
-    content_type = file.content_type or ""
-    is_image = content_type.startswith("image/") or suffix in [
-        ".jpg", ".jpeg", ".png", ".bmp", ".webp"
-    ]
-    is_video = content_type.startswith("video/") or suffix in [
-        ".mp4", ".avi", ".mov", ".mkv", ".webm"
-    ]
-
-    if is_image:
-        results = model.predict(source=temp_path, conf=conf, imgsz=imgsz, verbose=False)
-        annotated = results[0].plot()
-        out_name = f"annotated_{os.path.splitext(temp_name)[0]}.jpg"
-        out_path = os.path.join(OUTPUT_DIR, out_name)
-        cv2.imwrite(out_path, annotated)
+    kind = media_kind(file.content_type or "", suffix)
+    try:
+        sample_fps = parse_sample_fps(sample_fps)
+    except ValueError:
+        return {"error": f"sample_fps must be a number >= {MIN_SAMPLE_FPS}"}
+
+    if kind == "image":
+        raw = await read_image_upload(file)
+        if raw is None:
+            return {"error": "Image too large"}
+        out_name = await annotate_image(raw, conf, imgsz, os.path.splitext(temp_name)[0])
+        if out_name is None:
+            return {"error": "Could not decode image"}
         return {"type": "image", "result_url": f"/outputs/{out_name}"}
 
-    if is_video:
-        cap = cv2.VideoCapture(temp_path)
-        fps = cap.get(cv2.CAP_PROP_FPS) or 20.0
-        w, h = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    if kind == "video":
+        temp_path = os.path.join(OUTPUT_DIR, temp_name)
+        await save_upload(file, temp_path)
+
         out_name = f"annotated_{os.path.splitext(temp_name)[0]}.mp4"
         out_path = os.path.join(OUTPUT_DIR, out_name)
-        fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-        writer = cv2.VideoWriter(out_path, fourcc, fps, (w, h))
-
-        for result in model.predict(source=temp_path, conf=conf, imgsz=imgsz, stream=True, verbose=False):
-            frame = result.plot()
-            writer.write(frame)
-
-        cap.release()
-        writer.release()
+        await asyncio.get_running_loop().run_in_executor(
+            video_executor, process_video, temp_path, out_path, conf, imgsz, sample_fps
+        )
         return {"type": "video", "result_url": f"/outputs/{out_name}"}
 
     return {"error": "Unsupported file type"}